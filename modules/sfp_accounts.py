@@ -11,15 +11,31 @@
 # Licence:     GPL
 # -------------------------------------------------------------------------------
 
+import hashlib
 import json
 import random
+import re
 import threading
 import time
-from queue import Empty as QueueEmpty
-from queue import Queue
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
 
 from spiderfoot import SpiderFootEvent, SpiderFootPlugin
 
+# A site's check settings, resolved once rather than for every username
+AccountSite = namedtuple('AccountSite', [
+    'name',             # site name
+    'host',             # host of check_uri, for batching
+    'uriParts',         # check_uri split around each {account}
+    'existenceCode',    # status code when the account exists
+    'existenceString',  # bytes on the page when the account exists
+    'retprefix'         # result label, up to the URL
+])
+
 
 class sfp_accounts(SpiderFootPlugin):
 
@@ -36,6 +52,7 @@ class sfp_accounts(SpiderFootPlugin):
         "ignoreworddict": True,
         "musthavename": True,
         "userfromemail": True,
+        "cacheperiod": 24,
         "_maxthreads": 50
     }
 
@@ -45,32 +62,100 @@ class sfp_accounts(SpiderFootPlugin):
         "ignoreworddict": "Don't bother looking up names that appear in the dictionary.",
         "musthavename": "The username must be mentioned on the social media page to consider it valid (helps avoid false positives).",
         "userfromemail": "Extract usernames from e-mail addresses at all? If disabled this can reduce false positives for common usernames but for highly unique usernames it would result in missed accounts.",
+        "cacheperiod": "Hours to cache the accounts found for a username before checking the sites again. Set to 0 to disable.",
         "_maxthreads": "Maximum threads"
     }
 
     results = None
-    reportedUsers = list()
-    siteResults = dict()
+    reportedUsers = set()
     sites = list()
     errorState = False
     distrustedChecked = False
-    lock = None
+    proxies = None
+    sitesHash = None
+    sitesByHost = list()
+    maxCachedUsers = 1024
+
+    # Dictionaries, parsed site lists, distrusted site names and recent results,
+    # shared by every instance in the process so only the first scan pays for them.
+    _cacheLock = threading.Lock()
+    _distrustLock = threading.Lock()
+    _commonNames = None
+    _words = None
+    _blockedUsersCache = dict()
+    _sitesCache = dict()
+    _distrustedCache = dict()
+    _checkSitesCache = OrderedDict()
+
+    # Scan threads and HTTP connections, also shared by every instance so that
+    # concurrent scans interleave their checks rather than competing.
+    pool = None
+    http = None
+
+    @classmethod
+    def loadDicts(cls, sf):
+        with cls._cacheLock:
+            if cls._commonNames is None:
+                cls._commonNames = frozenset(sf.dictnames())
+                cls._words = frozenset(sf.dictwords())
+
+        return cls._commonNames, cls._words
+
+    # Every username we never look up, combined into one set per set of options
+    def loadBlockedUsers(self):
+        genericUsers = self.opts.get('_genericusers', '')
+        key = (genericUsers, self.opts['ignorenamedict'], self.opts['ignoreworddict'])
+
+        with self._cacheLock:
+            blocked = self._blockedUsersCache.get(key)
+            if blocked is None:
+                blocked = frozenset(genericUsers.split(","))
+                if self.opts['ignorenamedict']:
+                    blocked |= self.commonNames
+                if self.opts['ignoreworddict']:
+                    blocked |= self.words
+                self._blockedUsersCache[key] = blocked
+
+        return blocked
+
+    @classmethod
+    def startWorkers(cls, maxthreads, poolConnections):
+        with cls._cacheLock:
+            if cls.pool is not None:
+                return
+
+            cls.pool = ThreadPoolExecutor(
+                max_workers=maxthreads,
+                thread_name_prefix='sfp_accounts_scan'
+            )
+
+            # Keep a pool per site so hosts aren't evicted between users.
+            # Certificates are verified against requests' bundled CA store.
+            # Cookies are never stored, so one check can't affect another
+            # or link scans made through different proxies.
+            cls.http = requests.Session()
+            cls.http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(
+                pool_connections=poolConnections,
+                pool_maxsize=maxthreads * 4,
+                max_retries=0
+            )
+            cls.http.mount('https://', adapter)
+            cls.http.mount('http://', adapter)
 
     def setup(self, sfc, userOpts=dict()):
         self.sf = sfc
         self.results = self.tempStorage()
-        self.commonNames = list()
-        self.reportedUsers = list()
+        self.reportedUsers = set()
         self.errorState = False
         self.distrustedChecked = False
         self.__dataSource__ = "Social Media"
-        self.lock = threading.Lock()
 
         for opt in list(userOpts.keys()):
             self.opts[opt] = userOpts[opt]
 
-        self.commonNames = set(self.sf.dictnames())
-        self.words = set(self.sf.dictwords())
+        self.commonNames, self.words = self.loadDicts(self.sf)
+        self.blockedUsers = self.loadBlockedUsers()
 
         content = self.sf.cacheGet("sfaccounts", 48)
         if content is None:
@@ -85,12 +170,33 @@ class sfp_accounts(SpiderFootPlugin):
             content = data['content']
             self.sf.cachePut("sfaccounts", content)
 
-        try:
-            self.sites = [site for site in json.loads(content)['sites'] if site['valid']]
-        except Exception as e:
-            self.sf.error(f"Unable to parse social media accounts list: {e}")
-            self.errorState = True
-            return None
+        self.sitesHash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+        with self._cacheLock:
+            sites = self._sitesCache.get(self.sitesHash)
+            if sites is None:
+                try:
+                    sites = self.compileSites(json.loads(content)['sites'])
+                except Exception as e:
+                    self.sf.error(f"Unable to parse social media accounts list: {e}")
+                    self.errorState = True
+                    return None
+
+                # Only the current list is worth keeping
+                type(self)._sitesCache = {self.sitesHash: sites}
+
+        self.sites = sites
+        self.sitesByHost = self.groupSitesByHost(self.sites)
+
+        self.startWorkers(self.opts['_maxthreads'], max(len(self.sites), self.opts['_maxthreads']))
+
+        # The session is shared, so this scan's proxy is passed per request
+        self.proxies = dict()
+        if self.sf.socksProxy:
+            self.proxies = {
+                'http': self.sf.socksProxy,
+                'https': self.sf.socksProxy,
+            }
 
     def watchedEvents(self):
         return ["EMAILADDR", "DOMAIN_NAME", "HUMAN_NAME", "USERNAME"]
@@ -98,98 +204,202 @@ class sfp_accounts(SpiderFootPlugin):
     def producedEvents(self):
         return ["USERNAME", "ACCOUNT_EXTERNAL_OWNED"]
 
-    def checkSite(self, name, site):
-        if 'check_uri' not in site:
-            return None
+    def compileSites(self, sites):
+        compiled = list()
+        for site in sites:
+            try:
+                if not site['valid'] or 'check_uri' not in site:
+                    continue
+
+                if '{account}' not in site['check_uri']:
+                    self.sf.debug(f"Skipping {site['name']} as its check_uri has no {{account}} placeholder.")
+                    continue
+
+                compiled.append(AccountSite(
+                    name=site['name'],
+                    host=self.sf.urlFQDN(site['check_uri']),
+                    uriParts=tuple(site['check_uri'].split('{account}')),
+                    existenceCode=site.get('account_existence_code'),
+                    existenceString=(site.get('account_existence_string') or '').encode('utf-8'),
+                    retprefix=f"{site['name']} (Category: {site['category']})\n<SFURL>"
+                ))
+            except Exception as e:
+                self.sf.debug(f"Skipping malformed site entry {site}: {e}")
+
+        return compiled
+
+    # Batch the sites by host, so that each host's checks run one after the
+    # other on a single kept-alive connection.
+    def groupSitesByHost(self, sites):
+        hosts = dict()
+        for site in sites:
+            hosts.setdefault(site.host, list()).append(site)
 
-        url = site['check_uri'].format(account=name)
-        retname = f"{site['name']} (Category: {site['category']})\n<SFURL>{url}</SFURL>"
+        return list(hosts.values())
 
-        res = self.sf.fetchUrl(
+    def fetchSite(self, method, url):
+        return self.http.request(
+            method,
             url,
+            headers={'User-Agent': self.opts['_useragent']},
+            proxies=self.proxies,
             timeout=self.opts['_fetchtimeout'],
-            useragent=self.opts['_useragent'],
-            noLog=True,
-            verify=False
+            allow_redirects=True
         )
 
-        if not res['content']:
-            with self.lock:
-                self.siteResults[retname] = False
-            return
+    def checkSite(self, name, site, namePattern):
+        url = name.join(site.uriParts)
+        retname = f"{site.retprefix}{url}</SFURL>"
+
+        # When only the status code decides, there's no need for the body
+        headOnly = not (site.existenceString or self.opts['musthavename'] or "." in name)
+
+        try:
+            if headOnly:
+                res = self.fetchSite('HEAD', url)
+                if str(res.status_code) == site.existenceCode:
+                    return retname, True
+
+            # Many servers refuse HEAD (405, 501) or answer it differently,
+            # so a HEAD miss is confirmed with a GET before it counts.
+            res = self.fetchSite('GET', url)
+        except Exception as e:
+            # Neither found nor missing, so that the result isn't cached
+            self.sf.debug(f"Unable to fetch {url}: {e}")
+            return retname, None
+
+        if str(res.status_code) != site.existenceCode:
+            return retname, False
 
-        if res['code'] != site.get('account_existence_code'):
-            with self.lock:
-                self.siteResults[retname] = False
-            return
+        content = res.content
+        if not content:
+            return retname, False
 
-        if site.get('account_existence_string') not in res['content']:
-            with self.lock:
-                self.siteResults[retname] = False
-            return
+        if site.existenceString not in content:
+            return retname, False
 
         if self.opts['musthavename']:
-            if name.lower() not in res['content'].lower():
-                self.sf.debug(f"Skipping {site['name']} as username not mentioned.")
-                with self.lock:
-                    self.siteResults[retname] = False
-                return
+            if namePattern:
+                mentioned = namePattern.search(content)
+            else:
+                mentioned = name.casefold() in content.decode('utf-8', errors='ignore').casefold()
+
+            if not mentioned:
+                self.sf.debug(f"Skipping {site.name} as username not mentioned.")
+                return retname, False
 
         # Some sites can't handle periods so treat bob.abc and bob as the same
         # TODO: fix this once WhatsMyName has support for usernames with '.'
         if "." in name:
-            firstname = name.split(".")[0]
-            if firstname + "<" in res['content'] or firstname + '"' in res['content']:
-                with self.lock:
-                    self.siteResults[retname] = False
-                return
+            firstname = name.split(".")[0].encode('utf-8')
+            if firstname + b"<" in content or firstname + b'"' in content:
+                return retname, False
 
-        with self.lock:
-            self.siteResults[retname] = True
+        return retname, True
 
     def checkSites(self, username, sites=None):
-        def processSiteQueue(username, queue):
-            try:
-                while True:
-                    site = queue.get(timeout=0.1)
-                    try:
-                        self.checkSite(username, site)
-                    except Exception as e:
-                        self.sf.debug(f'Thread {threading.current_thread().name} exception: {e}')
-            except QueueEmpty:
-                return
+        def processSiteBatch(username, namePattern, batch):
+            return [self.checkSite(username, site, namePattern) for site in batch]
+
+        # The same username can arrive in several scans, so remember results
+        # for cacheperiod hours rather than checking every site again.
+        useCache = sites is None and self.opts['cacheperiod'] > 0
+        if useCache:
+            key = (self.sitesHash, self.opts['musthavename'], username)
+            with self._cacheLock:
+                entry = self._checkSitesCache.get(key)
+                if entry and time.monotonic() - entry[0] < self.opts['cacheperiod'] * 3600:
+                    self._checkSitesCache.move_to_end(key)
+                    return entry[1]
+
+            label = f"{username}|{self.sitesHash}|{self.opts['musthavename']}"
+            cacheLabel = "sfaccounts_res_" + hashlib.sha1(label.encode('utf-8')).hexdigest()
+
+            content = self.sf.cacheGet(cacheLabel, self.opts['cacheperiod'])
+            if content:
+                found = json.loads(content)
+                self.rememberSites(key, found)
+                return found
 
         startTime = time.monotonic()
 
-        # results will be collected in siteResults
-        self.siteResults = {}
+        # Search the raw page for the username case-insensitively, rather than
+        # lower-casing a copy of every page. Bytes patterns only fold ASCII
+        # case, so non-ASCII usernames are compared against the decoded page.
+        namePattern = None
+        if username.isascii():
+            namePattern = re.compile(re.escape(username.encode('utf-8')), re.IGNORECASE)
 
-        sites = self.sites if sites is None else sites
+        if sites is None:
+            sites = self.sites
+            batches = self.sitesByHost
+        else:
+            batches = self.groupSitesByHost(sites)
 
-        # load the queue
-        queue = Queue()
-        for site in sites:
-            queue.put(site)
-
-        # start the scan threads
-        threads = []
-        for i in range(min(len(sites), self.opts['_maxthreads'])):
-            thread = threading.Thread(
-                name=f'sfp_accounts_scan_{i}',
-                target=processSiteQueue,
-                args=(username, queue))
-            thread.start()
-            threads.append(thread)
-
-        # wait for all scan threads to finish
-        while threads:
-            threads.pop(0).join()
+        # parallelise across hosts rather than within them
+        futures = [self.pool.submit(processSiteBatch, username, namePattern, batch) for batch in batches]
+        siteResults = [result for future in as_completed(futures) for result in future.result()]
 
         duration = time.monotonic() - startTime
         scanRate = len(sites) / duration
-        self.sf.debug(f'Scan statistics: name={username}, count={len(self.siteResults)}, duration={duration:.2f}, rate={scanRate:.0f}')
+        self.sf.debug(f'Scan statistics: name={username}, count={len(siteResults)}, duration={duration:.2f}, rate={scanRate:.0f}')
+
+        found = [site for site, exists in siteResults if exists]
 
-        return [site for site, found in self.siteResults.items() if found]
+        # A site that couldn't be fetched may yet hold the account, so only
+        # complete results are worth remembering
+        if any(exists is None for site, exists in siteResults):
+            return found
+
+        if useCache:
+            self.rememberSites(key, found)
+            self.sf.cachePut(cacheLabel, json.dumps(found))
+
+        return found
+
+    def rememberSites(self, key, found):
+        with self._cacheLock:
+            self._checkSitesCache[key] = (time.monotonic(), found)
+            self._checkSitesCache.move_to_end(key)
+            if len(self._checkSitesCache) > self.maxCachedUsers:
+                self._checkSitesCache.popitem(last=False)
+
+    def distrustedSites(self):
+        # Every option that changes what the probe finds is part of the key,
+        # both here and on disk, so changing one runs the probe again
+        key = (self.sitesHash, self.opts['_fetchtimeout'], self.opts['_useragent'], self.opts['musthavename'])
+        cacheLabel = "sfaccounts_state_v2_" + hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+        # Hold the lock while probing so concurrent scans don't all probe
+        with self._distrustLock:
+            if key in self._distrustedCache:
+                return self._distrustedCache[key]
+
+            delsites = set()
+
+            # Check if a state cache exists first, to not have to do this all the time
+            content = self.sf.cacheGet(cacheLabel, 72)
+            if content:
+                if content != "None":  # "None" is written to the cached file when no sites are distrusted
+                    for line in content.split("\n"):
+                        if line == '':
+                            continue
+                        delsites.add(line)
+            else:
+                randpool = 'abcdefghijklmnopqrstuvwxyz1234567890'
+                randuser = ''.join(random.SystemRandom().choices(randpool, k=10))
+                res = self.checkSites(randuser, self.sites)
+                for site in res:
+                    sitename = site.split(" (Category:")[0]
+                    self.sf.debug(f"Distrusting {sitename}")
+                    delsites.add(sitename)
+
+                # The caching code needs *some* content
+                self.sf.cachePut(cacheLabel, sorted(delsites) if delsites else "None")
+
+            self._distrustedCache[key] = delsites
+
+        return delsites
 
     def handleEvent(self, event):
         eventName = event.eventType
@@ -207,7 +417,7 @@ class sfp_accounts(SpiderFootPlugin):
             self.sf.debug(f"Ignoring {eventName}, from self.")
             return None
 
-        if eventData in list(self.results.keys()):
+        if eventData in self.results:
             return None
 
         self.results[eventData] = True
@@ -215,32 +425,9 @@ class sfp_accounts(SpiderFootPlugin):
         # If being called for the first time, let's see how trusted the
         # sites are by attempting to fetch a garbage user.
         if not self.distrustedChecked:
-            # Check if a state cache exists first, to not have to do this all the time
-            content = self.sf.cacheGet("sfaccounts_state_v2", 72)
-            if content:
-                if content != "None":  # "None" is written to the cached file when no sites are distrusted
-                    delsites = list()
-                    for line in content.split("\n"):
-                        if line == '':
-                            continue
-                        delsites.append(line)
-                    self.sites = [d for d in self.sites if d['name'] not in delsites]
-            else:
-                randpool = 'abcdefghijklmnopqrstuvwxyz1234567890'
-                randuser = ''.join([random.SystemRandom().choice(randpool) for x in range(10)])
-                res = self.checkSites(randuser)
-                if res:
-                    delsites = list()
-                    for site in res:
-                        sitename = site.split(" (Category:")[0]
-                        self.sf.debug(f"Distrusting {sitename}")
-                        delsites.append(sitename)
-                    self.sites = [d for d in self.sites if d['name'] not in delsites]
-                else:
-                    # The caching code needs *some* content
-                    delsites = "None"
-                self.sf.cachePut("sfaccounts_state_v2", delsites)
-
+            distrusted = self.distrustedSites()
+            self.sites = [site for site in self.sites if site.name not in distrusted]
+            self.sitesByHost = self.groupSitesByHost(self.sites)
             self.distrustedChecked = True
 
         if eventName == "HUMAN_NAME":
@@ -262,23 +449,20 @@ class sfp_accounts(SpiderFootPlugin):
         if eventName == "USERNAME":
             users.append(eventData)
 
-        for user in set(users):
-            if user in self.opts['_genericusers'].split(","):
-                self.sf.debug(f"{user} is a generic account name, skipping.")
-                continue
-
-            if self.opts['ignorenamedict'] and user in self.commonNames:
-                self.sf.debug(f"{user} is found in our name dictionary, skipping.")
+        seen = set()
+        for user in users:
+            if user in seen:
                 continue
+            seen.add(user)
 
-            if self.opts['ignoreworddict'] and user in self.words:
-                self.sf.debug(f"{user} is found in our word dictionary, skipping.")
+            if user in self.blockedUsers:
+                self.sf.debug(f"{user} is a generic account name or found in our name/word dictionaries, skipping.")
                 continue
 
             if user not in self.reportedUsers and eventData != user:
                 evt = SpiderFootEvent("USERNAME", user, self.__name__, event)
                 self.notifyListeners(evt)
-                self.reportedUsers.append(user)
+                self.reportedUsers.add(user)
 
         # Only look up accounts when we've received a USERNAME event (possibly from
         # ourselves), since we want them to have gone through some verification by
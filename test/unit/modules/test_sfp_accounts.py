@@ -1,11 +1,48 @@
 # test_sfp_accounts.py
+import json
 import unittest
+from collections import OrderedDict
+
+import requests
+from requests.cookies import MockRequest, create_cookie
 
 from modules.sfp_accounts import sfp_accounts
 from sflib import SpiderFoot
 from spiderfoot import SpiderFootEvent, SpiderFootTarget
 
 
+class StubResponse:
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+class StubSession:
+    """
+    Stands in for the shared requests session, recording each request.
+    Unless a body is given, every page echoes its URL, so every site
+    appears to hold the account.
+    """
+
+    def __init__(self, body=None, headStatusCode=200, error=None):
+        self.requests = list()
+        self.body = body
+        self.headStatusCode = headStatusCode
+        self.error = error
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        if self.error:
+            raise self.error
+
+        if method == 'HEAD':
+            return StubResponse(self.headStatusCode, b'')
+
+        body = self.body if self.body is not None else f"<html>profile for {url}</html>"
+        return StubResponse(200, body.encode('utf-8'))
+
+
 class TestModuleaccounts(unittest.TestCase):
     """
     Test modules.sfp_accounts
@@ -33,6 +70,60 @@ class TestModuleaccounts(unittest.TestCase):
         '__logstdout': False
     }
 
+    sites = {
+        'sites': [
+            {
+                'name': 'Example',
+                'category': 'social',
+                'check_uri': 'https://example.com/user/{account}',
+                'account_existence_code': '200',
+                'account_existence_string': 'profile',
+                'valid': True
+            },
+            {
+                'name': 'Example Code',
+                'category': 'social',
+                'check_uri': 'https://example.org/{account}',
+                'account_existence_code': '200',
+                'valid': True
+            }
+        ]
+    }
+
+    def setUp(self):
+        """
+        Reset the state sfp_accounts shares between instances, so each test
+        starts as if in a fresh process.
+        """
+        if sfp_accounts.pool is not None:
+            sfp_accounts.pool.shutdown(wait=False)
+        sfp_accounts.pool = None
+        sfp_accounts.http = None
+        sfp_accounts._commonNames = None
+        sfp_accounts._words = None
+        sfp_accounts._blockedUsersCache = dict()
+        sfp_accounts._sitesCache = dict()
+        sfp_accounts._distrustedCache = dict()
+        sfp_accounts._checkSitesCache = OrderedDict()
+
+    def stubbed_module(self, cache, opts, sites=None):
+        """
+        Set up the module against an in-memory cache holding the sites list
+        and a stub session in place of HTTP.
+        """
+        sf = SpiderFoot(self.default_options)
+        cache['sfaccounts'] = json.dumps(self.sites if sites is None else sites)
+        sf.cacheGet = lambda label, timeoutHrs: cache.get(label)
+        sf.cachePut = lambda label, data: cache.__setitem__(label, data)
+
+        module = sfp_accounts()
+        # setup() writes options into the class-level dict, so give this
+        # instance its own copy to keep the tests independent
+        module.opts = dict(module.opts)
+        module.setup(sf, dict(self.default_options, **opts))
+        module.http = StubSession()
+        return module
+
     def test_opts(self):
         module = sfp_accounts()
         self.assertEqual(len(module.opts), len(module.optdescs))
@@ -46,6 +137,159 @@ class TestModuleaccounts(unittest.TestCase):
         module = sfp_accounts()
         module.setup(sf, dict())
 
+    def test_checkSites_should_return_cached_results_without_fetching(self):
+        cache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 24, 'musthavename': True})
+        module.sf.cacheGet = lambda label, timeoutHrs: '["cached account"]' if label.startswith('sfaccounts_res_') else cache.get(label)
+
+        self.assertEqual(module.checkSites('cacheduser'), ['cached account'])
+        self.assertEqual(module.http.requests, [])
+
+    def test_checkSites_should_store_results_in_cache(self):
+        cache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 24, 'musthavename': True})
+
+        found = module.checkSites('storeduser')
+
+        self.assertEqual(len(found), 2)
+        cached = [json.loads(v) for k, v in cache.items() if k.startswith('sfaccounts_res_')]
+        self.assertEqual(cached, [found])
+
+    def test_checkSites_cacheperiod_zero_should_bypass_cache(self):
+        cache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 0, 'musthavename': True})
+        module.sf.cacheGet = lambda label, timeoutHrs: '["cached account"]' if label.startswith('sfaccounts_res_') else cache.get(label)
+
+        found = module.checkSites('uncacheduser')
+
+        self.assertNotIn('cached account', found)
+        self.assertEqual(len(module.http.requests), 2)
+        self.assertFalse([k for k in cache if k.startswith('sfaccounts_res_')])
+
+    def test_setup_should_skip_malformed_site_entries(self):
+        sites = {'sites': self.sites['sites'] + [
+            {'name': 'No Category', 'check_uri': 'https://example.net/{account}', 'valid': True},
+            {'name': 'No Placeholder', 'category': 'social', 'check_uri': 'https://example.net/profile', 'valid': True},
+            'not a site'
+        ]}
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': True}, sites)
+
+        self.assertFalse(module.errorState)
+        self.assertEqual([site.name for site in module.sites], ['Example', 'Example Code'])
+
+    def test_checkSite_should_fill_every_account_placeholder(self):
+        sites = {'sites': [{
+            'name': 'Subdomain',
+            'category': 'social',
+            'check_uri': 'https://{account}.example.com/u/{account}',
+            'account_existence_code': '200',
+            'valid': True
+        }]}
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': True}, sites)
+
+        module.checkSites('someone')
+
+        self.assertEqual(module.http.requests, [('GET', 'https://someone.example.com/u/someone')])
+
+    def test_checkSite_should_match_non_ascii_username_case_insensitively(self):
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': True})
+        module.http = StubSession("<html>profile for JOSÉ</html>")
+
+        self.assertEqual(len(module.checkSites('josé')), 2)
+
+    def test_checkSites_cacheperiod_zero_should_bypass_memory_cache(self):
+        module = self.stubbed_module(dict(), {'cacheperiod': 24, 'musthavename': True})
+        self.assertEqual(len(module.checkSites('alice')), 2)
+
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': True})
+        module.http = StubSession(error=ConnectionError('unreachable'))
+
+        self.assertEqual(module.checkSites('alice'), [])
+        self.assertEqual(len(module.http.requests), 2)
+
+    def test_checkSites_should_expire_memory_cache_after_cacheperiod(self):
+        module = self.stubbed_module(dict(), {'cacheperiod': 24, 'musthavename': True})
+        self.assertEqual(len(module.checkSites('expireduser')), 2)
+
+        # Age every remembered result past the cache period
+        for key, (stored, found) in sfp_accounts._checkSitesCache.items():
+            sfp_accounts._checkSitesCache[key] = (stored - 25 * 3600, found)
+
+        module = self.stubbed_module(dict(), {'cacheperiod': 24, 'musthavename': True})
+        module.checkSites('expireduser')
+
+        self.assertEqual(len(module.http.requests), 2)
+
+    def test_checkSites_should_not_cache_results_when_a_fetch_fails(self):
+        cache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 24, 'musthavename': True})
+        module.http = StubSession(error=ConnectionError('unreachable'))
+
+        self.assertEqual(module.checkSites('unreachableuser'), [])
+        self.assertFalse([k for k in cache if k.startswith('sfaccounts_res_')])
+
+        module.http = StubSession()
+
+        self.assertEqual(len(module.checkSites('unreachableuser')), 2)
+        self.assertEqual(len(module.http.requests), 2)
+
+    def test_checkSite_should_use_head_when_only_status_code_matters(self):
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': False})
+
+        found = module.checkSites('headuser')
+
+        self.assertEqual(len(found), 2)
+        self.assertEqual(
+            sorted(module.http.requests),
+            [('GET', 'https://example.com/user/headuser'), ('HEAD', 'https://example.org/headuser')]
+        )
+
+    def test_checkSite_should_fall_back_to_get_when_head_is_refused(self):
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': False})
+        module.http = StubSession(headStatusCode=405)
+
+        found = module.checkSites('headuser')
+
+        self.assertEqual(len(found), 2)
+        self.assertIn(('HEAD', 'https://example.org/headuser'), module.http.requests)
+        self.assertIn(('GET', 'https://example.org/headuser'), module.http.requests)
+
+    def test_distrustedSites_should_probe_once_per_process(self):
+        cache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 0, 'musthavename': False})
+
+        self.assertEqual(module.distrustedSites(), {'Example', 'Example Code'})
+        self.assertEqual(len(module.http.requests), 2)
+
+        module = self.stubbed_module(dict(), {'cacheperiod': 0, 'musthavename': False})
+
+        self.assertEqual(module.distrustedSites(), {'Example', 'Example Code'})
+        self.assertEqual(module.http.requests, [])
+
+    def test_distrustedSites_should_probe_again_when_options_change(self):
+        cache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 0, 'musthavename': True})
+        module.http = StubSession("<html>profile</html>")
+
+        self.assertEqual(module.distrustedSites(), set())
+
+        # Without musthavename, a site answering 200 for any name is distrusted,
+        # even though the on-disk state from the first probe is still there
+        sfp_accounts._distrustedCache = dict()
+        module = self.stubbed_module(cache, {'cacheperiod': 0, 'musthavename': False})
+        module.http = StubSession("<html>profile</html>")
+
+        self.assertEqual(module.distrustedSites(), {'Example', 'Example Code'})
+        self.assertEqual(len(module.http.requests), 2)
+
+    def test_startWorkers_session_should_not_store_cookies(self):
+        sfp_accounts.startWorkers(1, 1)
+
+        request = MockRequest(requests.Request('GET', 'https://example.com/').prepare())
+        cookie = create_cookie('session', 'abc', domain='example.com')
+
+        self.assertFalse(sfp_accounts.http.cookies.get_policy().set_ok(cookie, request))
+
     def test_watchedEvents_should_return_list(self):
         module = sfp_accounts()
         self.assertIsInstance(module.watchedEvents(), list)